@@ -0,0 +1,173 @@
+import json
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+
+class HyperLogLog:
+    """
+    Approximate distinct counter over 64-bit hashes.
+
+    With the default precision of 12 it keeps 4096 one-byte registers and
+    has a standard error of about 1.6%. Counters built over different chunks
+    can be merged.
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def update(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if not len(hashes):
+            return self
+        buckets = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        remainder = hashes & np.uint64((1 << (64 - self.precision)) - 1)
+        # frexp gives floor(log2(remainder)) + 1 exactly, as the remainder fits in a float mantissa
+        _, exponents = np.frexp(remainder.astype(np.float64))
+        ranks = (64 - self.precision - exponents + 1).astype(np.uint8)
+        np.maximum.at(self.registers, buckets, ranks)
+        return self
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        empty = np.count_nonzero(self.registers == 0)
+        if raw <= 2.5 * m and empty:
+            # Linear counting is more accurate for small cardinalities
+            return int(round(m * np.log(m / empty)))
+        return int(round(raw))
+
+
+class ColumnStats:
+    """
+    Running statistics of one column.
+
+    Attributes
+    ----------
+    name : str
+        The column name.
+    dtype : str
+        The pandas dtype of the first chunk seen.
+    count : int
+        The number of values, including nulls.
+    null_count : int
+        The number of null values.
+    max_length : int or None
+        The longest string representation, for text columns only.
+    min, max : object
+        The smallest and largest non-null values, when they can be compared.
+    distinct : HyperLogLog
+        The approximate distinct counter of the non-null values.
+    """
+
+    def __init__(self, name, dtype):
+        self.name = name
+        self.dtype = dtype
+        self.count = 0
+        self.null_count = 0
+        self.max_length = None
+        self.min = None
+        self.max = None
+        self.distinct = HyperLogLog()
+        self._comparable = True
+
+    def update(self, values):
+        self.count += len(values)
+        non_null = values.dropna()
+        self.null_count += len(values) - len(non_null)
+        values = non_null
+        if not len(values):
+            return self
+        self.distinct.update(pd.util.hash_pandas_object(values, index=False).to_numpy())
+
+        is_text = pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)
+        if is_text:
+            length = int(values.astype(str).str.len().max())
+            self.max_length = length if self.max_length is None else max(self.max_length, length)
+        if self._comparable:
+            try:
+                low, high = values.min(), values.max()
+                self.min = low if self.min is None else min(self.min, low)
+                self.max = high if self.max is None else max(self.max, high)
+            except TypeError:
+                # Mixed types cannot be ordered
+                self._comparable = False
+                self.min = self.max = None
+        return self
+
+    def to_dict(self):
+        return {
+            'dtype': self.dtype,
+            'count': self.count,
+            'null_count': self.null_count,
+            'max_length': self.max_length,
+            'approx_distinct': self.distinct.estimate(),
+            'min': self.min.item() if isinstance(self.min, np.generic) else self.min,
+            'max': self.max.item() if isinstance(self.max, np.generic) else self.max,
+        }
+
+
+class ColumnStatsCollector:
+    """
+    Single-pass column statistics over one or more chunks of a table.
+
+    Every chunk is visited once to update the row and null counts, the
+    maximum string length, the approximate distinct count (HyperLogLog) and
+    the min/max of each column. The maximum lengths drive the VARCHAR sizes
+    chosen by DatabaseConnector.build_dtype, and the whole profile is saved
+    as a JSON artifact for each load.
+
+    Methods
+    -------
+    update(df):
+        Adds a chunk to the statistics.
+    max_length(column):
+        Returns the longest value seen in a text column.
+    to_frame():
+        Returns the statistics with one row per column.
+    save(path, table_name, scope):
+        Writes the statistics as a JSON data profile.
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
+
+    def update(self, df):
+        self.rows += len(df)
+        for name in df.columns:
+            if name not in self.columns:
+                self.columns[name] = ColumnStats(name, str(df[name].dtype))
+            self.columns[name].update(df[name])
+        return self
+
+    def max_length(self, column):
+        # 0 for columns that were never seen, matching what upload_to_db used before
+        if column not in self.columns:
+            return 0
+        return self.columns[column].max_length
+
+    def to_frame(self):
+        return pd.DataFrame.from_dict({name: stats.to_dict() for name, stats in self.columns.items()}, orient='index')
+
+    def save(self, path, table_name, scope='full'):
+        # scope is 'full' when the statistics cover every row of the table after the load, and
+        # 'partial' for appends, partition reloads and failed loads, whose table holds other rows too
+        profile = {
+            'table': table_name,
+            'generated_at': datetime.now(timezone.utc).isoformat(),
+            'scope': scope,
+            'rows': self.rows,
+            'columns': {name: stats.to_dict() for name, stats in self.columns.items()},
+        }
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(profile, file, indent=2, default=str)
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import re
 import uuid
@@ -12,9 +13,129 @@ class DataCleaning:
 
     def clean_card_data(self, df):
         df = df.copy()
-        df['expiry_date'] = df['expiry_date'].astype(str)
-        df['date_payment_confirmed'] = pd.to_datetime(df['date_payment_confirmed'], errors='coerce')
-        return df
+        # Card numbers read from the PDF can be parsed as floats when a page has gaps
+        card_numbers = df['card_number']
+        if pd.api.types.is_float_dtype(card_numbers):
+            card_numbers = card_numbers.astype('Int64')
+        card_numbers = card_numbers.astype(str)
+
+        # Strip stray characters such as '?'; the byte matrix of the Luhn check tells which numbers
+        # need the regex. Missing numbers and repeated header lines end up without digits and fail the check.
+        chars = self.card_number_bytes(card_numbers)
+        dirty = self.has_non_digits(chars)
+        if dirty.any():
+            card_numbers = card_numbers.copy()
+            card_numbers[dirty] = card_numbers[dirty].str.replace(r'\D', '', regex=True)
+            chars[:, dirty] = self.card_number_bytes(card_numbers[dirty])
+        df['card_number'] = card_numbers
+
+        df['expiry_date'], valid_expiry = self.check_expiry_dates(df['expiry_date'])
+        # Payment dates repeat a lot, so each distinct value is parsed only once; null rows get code -1,
+        # which reindex maps to a missing value
+        payment_codes, payment_values = pd.factorize(df['date_payment_confirmed'])
+        df['date_payment_confirmed'] = pd.Series(pd.to_datetime(payment_values, errors='coerce')).reindex(payment_codes).to_numpy()
+
+        valid = self.luhn_valid_bytes(chars) & valid_expiry
+        df = df[valid]
+        return df[~self.duplicated_card_numbers(chars, valid)]
+
+    @staticmethod
+    def check_expiry_dates(expiry_dates):
+        # Returns the stripped expiry dates and whether each is a valid MM/YY date. Values already
+        # in that exact form are checked on their bytes; only the others are stripped and parsed.
+        try:
+            chars = np.asarray(expiry_dates.array).astype('S6').view(np.uint8).reshape(-1, 6)
+            digits = chars[:, [0, 1, 3, 4]] - np.uint8(ord('0'))
+            month = digits[:, 0].astype(np.int8) * 10 + digits[:, 1]
+            exact = (chars[:, 5] == 0) & (chars[:, 2] == ord('/')) & (digits <= 9).all(axis=1) & (month >= 1) & (month <= 12)
+        except UnicodeEncodeError:
+            exact = np.zeros(len(expiry_dates), dtype=bool)
+        valid = exact.copy()
+        if exact.all():
+            return expiry_dates, valid
+
+        # The remaining values repeat a lot, so each distinct one is parsed once; null rows get code -1,
+        # which reindex maps to a missing value
+        others = expiry_dates[~exact]
+        codes, distinct = pd.factorize(others)
+        stripped = pd.Series(pd.Index(distinct).astype(str).str.strip())
+        # %m/%y on its own also accepts single-digit months such as '1/26'
+        parsed = stripped.str.fullmatch(r'\d{2}/\d{2}') & pd.to_datetime(stripped, format='%m/%y', errors='coerce').notna()
+        valid[~exact] = parsed.reindex(codes, fill_value=False).to_numpy()
+        expiry_dates = expiry_dates.copy()
+        expiry_dates[~exact] = stripped.reindex(codes).to_numpy()
+        return expiry_dates, valid
+
+    @staticmethod
+    def card_number_bytes(card_numbers, max_length=19):
+        # Lays strings out as a matrix of ASCII codes with one column per card number, so the
+        # per-number sums run over contiguous rows, plus one spare row to catch numbers that are too long
+        width = max_length + 1
+        # The strings must not be null; np.asarray skips the null scan of Series.to_numpy
+        try:
+            chars = np.asarray(card_numbers.array).astype(f'S{width}')
+        except UnicodeEncodeError:
+            # A non-ASCII character can never be part of a valid number
+            chars = np.asarray(card_numbers.where(card_numbers.str.isascii(), '?').array).astype(f'S{width}')
+        return np.ascontiguousarray(chars.view(np.uint8).reshape(-1, width).T)
+
+    @staticmethod
+    def has_non_digits(chars):
+        # Numbers filling the spare row are too long and may only need their separators removed
+        is_other = (chars != 0) & ((chars < ord('0')) | (chars > ord('9')))
+        return is_other.any(axis=0) | (chars[-1] != 0)
+
+    @staticmethod
+    def luhn_valid(card_numbers, min_length=12, max_length=19):
+        chars = DataCleaning.card_number_bytes(card_numbers.fillna(''), max_length)
+        return pd.Series(DataCleaning.luhn_valid_bytes(chars, min_length), index=card_numbers.index)
+
+    @staticmethod
+    def luhn_valid_bytes(chars, min_length=12):
+        # chars comes from card_number_bytes; its last row is the spare one
+        too_long = chars[-1] != 0
+        chars = chars[:-1]
+        lengths = (chars != 0).sum(axis=0, dtype=np.int8)
+        digits = chars - np.uint8(ord('0'))  # padding and other characters wrap around to values above 9
+        is_digit = digits <= 9
+        valid = ~too_long & (lengths >= min_length) & (is_digit.sum(axis=0, dtype=np.int8) == lengths)
+        digits *= is_digit
+
+        # Every second digit counting from the rightmost one is doubled, which falls on the even
+        # rows for even lengths and on the odd rows otherwise. Doubling d adds d, minus 9 when d >= 5.
+        even, odd = digits[0::2], digits[1::2]
+        even_sum = even.sum(axis=0, dtype=np.int16)
+        odd_sum = odd.sum(axis=0, dtype=np.int16)
+        even_carry = (even >= 5).sum(axis=0, dtype=np.int16)
+        odd_carry = (odd >= 5).sum(axis=0, dtype=np.int16)
+        total = np.where(
+            lengths % 2 == 0,
+            2 * even_sum - 9 * even_carry + odd_sum,
+            even_sum + 2 * odd_sum - 9 * odd_carry,
+        )
+        return valid & (total % 10 == 0)
+
+    @staticmethod
+    def duplicated_card_numbers(chars, valid):
+        # Marks the repeated numbers among the valid ones, given their byte matrix. Their left-aligned
+        # integer values hash much faster than the strings and are unique among numbers of equal
+        # length, so every length is deduplicated on its own.
+        rows = chars[:-1]
+        digits = rows - np.uint8(ord('0'))
+        digits *= rows != 0
+        values = np.zeros(rows.shape[1], dtype=np.uint64)
+        for power, row in zip(10 ** np.arange(len(rows) - 1, -1, -1, dtype=np.uint64), digits):
+            values += row * power
+        values = values[valid]
+        lengths = (rows != 0).sum(axis=0, dtype=np.int8)[valid]
+        distinct_lengths = np.unique(lengths)
+        if len(distinct_lengths) == 1:
+            return pd.Series(values).duplicated().to_numpy()
+        duplicated = np.zeros(len(values), dtype=bool)
+        for length in distinct_lengths:
+            same_length = lengths == length
+            duplicated[same_length] = pd.Series(values[same_length]).duplicated().to_numpy()
+        return duplicated
 
     @staticmethod
     def convert_weight(weight):
@@ -54,11 +175,6 @@ class DataCleaning:
         return df
 
     def clean_orders_data(self, df):
-        # Calculate max lengths for VARCHAR fields
-        max_card_number_length = df['card_number'].astype(str).str.len().max()
-        max_store_code_length = df['store_code'].astype(str).str.len().max()
-        max_product_code_length = df['product_code'].astype(str).str.len().max()
-
         # Cast columns to required data types
         df['date_uuid'] = df['date_uuid'].apply(lambda x: str(uuid.UUID(x)) if pd.notna(x) else None)
         df['user_uuid'] = df['user_uuid'].apply(lambda x: str(uuid.UUID(x)) if pd.notna(x) else None)
@@ -72,9 +188,57 @@ class DataCleaning:
 
         return df
 
+    def add_store_country_code(self, orders_df, stores_df):
+        # Look up the country of each order's store so orders_table can be partitioned by country
+        country_codes = stores_df.drop_duplicates(subset=['store_code']).set_index('store_code')['country_code']
+        orders_df = orders_df.copy()
+        orders_df['country_code'] = orders_df['store_code'].map(country_codes)
+        return orders_df
+
+    def add_order_month(self, orders_df, date_details_df):
+        # Look up the month of each order so orders_table can be partitioned by month
+        months = pd.to_datetime(pd.DataFrame({
+            'year': pd.to_numeric(date_details_df['year'], errors='coerce'),
+            'month': pd.to_numeric(date_details_df['month'], errors='coerce'),
+            'day': 1,
+        }), errors='coerce')
+        order_months = pd.Series(months.values, index=date_details_df['date_uuid'].astype(str))
+        order_months = order_months[~order_months.index.duplicated()]
+        orders_df = orders_df.copy()
+        orders_df['order_month'] = orders_df['date_uuid'].astype(str).map(order_months)
+        return orders_df
+
     def clean_date_details(self, date_details_df):
-        # Clean the date details data
-        return date_details_df
+        df = date_details_df.copy()
+        # Each part has few distinct values, so only those are parsed; invalid parts become NaN/NaT
+        years = self.parse_distinct(df['year'], lambda values: pd.to_numeric(values, errors='coerce'))
+        months = self.parse_distinct(df['month'], lambda values: pd.to_numeric(values, errors='coerce'))
+        days = self.parse_distinct(df['day'], lambda values: pd.to_numeric(values, errors='coerce'))
+        times = self.parse_distinct(df['timestamp'], lambda values: pd.to_datetime(values, format='%H:%M:%S', errors='coerce') - pd.Timestamp('1900-01-01'))
+
+        # Assemble the full timestamp in one pass and drop the rows that do not form a valid date
+        date_values = pd.to_datetime(pd.DataFrame({'year': years, 'month': months, 'day': days}, index=df.index), errors='coerce') + times
+        df = df[date_values.notna()].copy()
+        date_values = date_values[date_values.notna()]
+
+        # Precompute the calendar columns so queries can group and range-scan without per-row date math
+        df['date_value'] = date_values
+        df['year'] = date_values.dt.year.astype('int16')
+        df['month'] = date_values.dt.month.astype('int16')
+        df['day'] = date_values.dt.day.astype('int16')
+        df['month_start'] = date_values.to_numpy().astype('datetime64[M]').astype(date_values.dtype)
+        df['quarter'] = date_values.dt.quarter.astype('int16')
+        df['weekday'] = date_values.dt.dayofweek.astype('int16')  # Monday is 0
+        df['time_period'] = df['time_period'].str.strip()
+        return df
+
+    @staticmethod
+    def parse_distinct(values, parser):
+        # Parses every distinct value once and maps the results back onto the rows;
+        # null rows get code -1, which reindex turns into NaN/NaT
+        codes, distinct = pd.factorize(values.astype(str))
+        parsed = pd.Series(parser(pd.Index(distinct).str.strip()))
+        return pd.Series(parsed.reindex(codes).to_numpy(), index=values.index)
 
     def clean_users_data(self, df):
         # Converting 'first_name' and 'last_name' to VARCHAR(255)
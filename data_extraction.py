@@ -3,9 +3,14 @@ import tabula
 import requests
 import boto3
 import yaml
+import argparse
 from io import StringIO
 from database_utils import DatabaseConnector
 from data_cleaning import DataCleaning
+from parallel_cleaning import ParallelCleaner
+from streaming_pipeline import StreamingPipeline
+from profiling import PROFILE_ENV_VAR, enable_profiling, profile_stage
+from store_locator import StoreLocationIndex
 
 # Load API key from config.yaml
 with open('config.yaml', 'r') as file:
@@ -27,6 +32,9 @@ class DataExtractor:
     extract_from_db(table_name, creds_file):
         Extracts data from a database table.
         
+    extract_from_db_in_chunks(table_name, creds_file, chunksize):
+        Extracts data from a database table in chunks.
+        
     retrieve_pdf_data(pdf_url):
         Extracts data from a PDF file located at the specified URL.
         
@@ -68,6 +76,30 @@ class DataExtractor:
         df = pd.read_sql_query(query, engine)
         return df
 
+    def extract_from_db_in_chunks(self, table_name, creds_file, chunksize=20000):
+        """
+        Extracts data from a database table in chunks.
+
+        Parameters
+        ----------
+        table_name : str
+            The name of the table to extract data from.
+        creds_file : str
+            The path to the credentials file for database connection.
+        chunksize : int
+            The number of rows in each chunk.
+
+        Yields
+        ------
+        DataFrame
+            A pandas DataFrame containing the next chunk of rows from the table.
+        """
+        engine = self.db_connector.init_db_engine(creds_file)
+        query = f"SELECT * FROM {table_name}"
+        with engine.connect().execution_options(stream_results=True) as connection:
+            for chunk in pd.read_sql_query(query, connection, chunksize=chunksize):
+                yield chunk
+
     def retrieve_pdf_data(self, pdf_url):
         """
         Extracts data from a PDF file located at the specified URL.
@@ -189,6 +221,13 @@ class DataExtractor:
             return pd.DataFrame()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract, clean and upload the retail data.")
+    parser.add_argument('--profile', metavar='DIR', help=f"write per-stage profiling reports to DIR (or set {PROFILE_ENV_VAR})")
+    parser.add_argument('--partition-orders', choices=['country', 'month'], help="load orders_table as a table partitioned by store country or by order month")
+    args = parser.parse_args()
+    if args.profile:
+        enable_profiling(args.profile)
+
     data_extractor = DataExtractor()
     data_cleaning = DataCleaning()
     db_connector = data_extractor.db_connector
@@ -203,10 +242,16 @@ if __name__ == "__main__":
     
     try:
         number_of_stores = data_extractor.list_number_of_stores(number_of_stores_endpoint, headers)
-        stores_data_df = data_extractor.retrieve_stores_data(store_details_endpoint, headers, number_of_stores)
-        cleaned_stores_data = data_cleaning.clean_store_data(stores_data_df)
-        db_connector.upload_to_db(cleaned_stores_data, 'dim_store_details', 'new_db_creds.yaml')
+        with profile_stage('dim_store_details.extract'):
+            stores_data_df = data_extractor.retrieve_stores_data(store_details_endpoint, headers, number_of_stores)
+        with profile_stage('dim_store_details.clean'):
+            cleaned_stores_data = data_cleaning.clean_store_data(stores_data_df)
+        with profile_stage('dim_store_details.upload'):
+            db_connector.upload_to_db(cleaned_stores_data, 'dim_store_details', 'new_db_creds.yaml')
         print("Cleaned stores data uploaded to dim_store_details table in sales_data database.")
+        # Persist the grid index next to the store dimension for nearest-store lookups
+        store_index = StoreLocationIndex.from_frame(cleaned_stores_data)
+        db_connector.upload_to_db(store_index.to_frame(), 'dim_store_locations', 'new_db_creds.yaml')
     except Exception as e:
         print(f"An error occurred while processing store data: {e}")
 
@@ -214,9 +259,12 @@ if __name__ == "__main__":
     pdf_url = "https://data-handling-public.s3.eu-west-1.amazonaws.com/card_details.pdf"
     
     try:
-        pdf_data = data_extractor.retrieve_pdf_data(pdf_url)
-        cleaned_pdf_data = data_cleaning.clean_card_data(pdf_data)
-        db_connector.upload_to_db(cleaned_pdf_data, 'dim_card_details', 'new_db_creds.yaml')
+        with profile_stage('dim_card_details.extract'):
+            pdf_data = data_extractor.retrieve_pdf_data(pdf_url)
+        with profile_stage('dim_card_details.clean'):
+            cleaned_pdf_data = data_cleaning.clean_card_data(pdf_data)
+        with profile_stage('dim_card_details.upload'):
+            db_connector.upload_to_db(cleaned_pdf_data, 'dim_card_details', 'new_db_creds.yaml')
         print("Cleaned PDF data uploaded to dim_card_details table in sales_data database.")
     except Exception as e:
         print(f"An error occurred while processing card data: {e}")
@@ -225,31 +273,64 @@ if __name__ == "__main__":
     s3_address = "s3://data-handling-public/products.csv"
     
     try:
-        products_data_df = data_extractor.extract_from_s3(s3_address)
-        cleaned_products_data = data_cleaning.clean_products_data(products_data_df)
-        db_connector.upload_to_db(cleaned_products_data, 'dim_products', 'new_db_creds.yaml')
+        with profile_stage('dim_products.extract'):
+            products_data_df = data_extractor.extract_from_s3(s3_address)
+        with profile_stage('dim_products.clean'):
+            cleaned_products_data = data_cleaning.clean_products_data(products_data_df)
+        with profile_stage('dim_products.upload'):
+            db_connector.upload_to_db(cleaned_products_data, 'dim_products', 'new_db_creds.yaml')
         print("Cleaned products data uploaded to dim_products table in sales_data database.")
     except Exception as e:
         print(f"An error occurred while processing product data: {e}")
 
-    # Extract and upload orders data
-    orders_table_name = 'orders_table'
-    
-    try:
-        orders_df = data_extractor.extract_from_db(orders_table_name, 'db_creds.yaml')
-        cleaned_orders_data = data_cleaning.clean_orders_data(orders_df)
-        db_connector.upload_to_db(cleaned_orders_data, 'orders_table', 'new_db_creds.yaml')
-        print("Cleaned orders data uploaded to orders_table in sales_data database.")
-    except Exception as e:
-        print(f"An error occurred while processing orders data: {e}")
-
     # Extract and upload date details data from JSON
     json_url = "https://data-handling-public.s3.eu-west-1.amazonaws.com/date_details.json"
     
     try:
-        date_details_df = data_extractor.extract_json_from_s3(json_url)
-        cleaned_date_details = data_cleaning.clean_date_details(date_details_df)
-        db_connector.upload_to_db(cleaned_date_details, 'dim_date_times', 'new_db_creds.yaml')
+        with profile_stage('dim_date_times.extract'):
+            date_details_df = data_extractor.extract_json_from_s3(json_url)
+        with profile_stage('dim_date_times.clean'):
+            cleaned_date_details = data_cleaning.clean_date_details(date_details_df)
+        with profile_stage('dim_date_times.upload'):
+            db_connector.upload_to_db(cleaned_date_details, 'dim_date_times', 'new_db_creds.yaml')
+            # date_value is precomputed by clean_date_details, so date range filters can use an index
+            db_connector.create_index('dim_date_times', 'date_value', 'new_db_creds.yaml')
         print("Cleaned date details data uploaded to dim_date_times table in sales_data database.")
     except Exception as e:
         print(f"An error occurred while processing date details data: {e}")
+
+    # Extract and upload orders data
+    orders_table_name = 'orders_table'
+    
+    # The UUID parsing in clean_orders_data is the heaviest per-row cleaning, so each
+    # 20,000-row chunk is cleaned across a process pool that lives for the whole load
+    orders_cleaner = ParallelCleaner(data_cleaning, min_rows=10000)
+    try:
+        clean_orders = lambda chunk: orders_cleaner.run('clean_orders_data', chunk)
+        partition_column, partition_by = None, 'list'
+        if args.partition_orders == 'country':
+            # Partition by the country of the store, looked up in the store dimension loaded above
+            stores_df = db_connector.read_rds_table('dim_store_details', 'new_db_creds.yaml')
+            clean_orders = lambda chunk: data_cleaning.add_store_country_code(orders_cleaner.run('clean_orders_data', chunk), stores_df)
+            partition_column = 'country_code'
+        elif args.partition_orders == 'month':
+            # Partition by the month of the order, looked up in the date dimension loaded above
+            date_times_df = db_connector.read_rds_table('dim_date_times', 'new_db_creds.yaml')
+            clean_orders = lambda chunk: data_cleaning.add_order_month(orders_cleaner.run('clean_orders_data', chunk), date_times_df)
+            partition_column, partition_by = 'order_month', 'range'
+
+        # Stream the orders in chunks so extraction, cleaning and upload overlap
+        orders_chunks = data_extractor.extract_from_db_in_chunks(orders_table_name, 'db_creds.yaml')
+        orders_pipeline = StreamingPipeline(
+            orders_chunks, clean_orders, db_connector, 'orders_table', 'new_db_creds.yaml',
+            partition_column=partition_column, partition_by=partition_by,
+        )
+        orders_report = orders_pipeline.run()
+        if orders_report['failed']:
+            print("Orders data was not fully uploaded to orders_table; see the errors above.")
+        else:
+            print("Cleaned orders data uploaded to orders_table in sales_data database.")
+    except Exception as e:
+        print(f"An error occurred while processing orders data: {e}")
+    finally:
+        orders_cleaner.close()
@@ -1,12 +1,55 @@
 import psycopg2
 import yaml
+import os
 import pandas as pd
-from sqlalchemy import create_engine, inspect, types
+import re
+from sqlalchemy import create_engine, text, types
+from column_stats import ColumnStatsCollector
+
+# Text columns whose VARCHAR length is sized from the data
+VARCHAR_COLUMNS = ['card_number', 'store_code', 'product_code', 'country_code']
+
+# Columns, types, constraints, indexes and row estimates of every table in a schema, in one round-trip.
+# Partitions are folded into their parent table.
+CATALOG_QUERY = """
+SELECT
+    c.relname AS table_name,
+    a.attnum AS ordinal_position,
+    a.attname AS column_name,
+    pg_catalog.format_type(a.atttypid, a.atttypmod) AS data_type,
+    NOT a.attnotnull AS is_nullable,
+    con.constraints,
+    idx.indexes,
+    CASE WHEN c.relkind = 'p' THEN (
+        SELECT COALESCE(SUM(GREATEST(p.reltuples, 0)), 0)
+        FROM pg_catalog.pg_inherits h
+        JOIN pg_catalog.pg_class p ON p.oid = h.inhrelid
+        WHERE h.inhparent = c.oid
+    ) ELSE GREATEST(c.reltuples, 0) END::bigint AS row_estimate
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+LEFT JOIN LATERAL (
+    SELECT string_agg(k.conname || ' ' || pg_catalog.pg_get_constraintdef(k.oid), '; ' ORDER BY k.conname) AS constraints
+    FROM pg_catalog.pg_constraint k
+    WHERE k.conrelid = c.oid AND a.attnum = ANY (k.conkey)
+) con ON true
+LEFT JOIN LATERAL (
+    SELECT string_agg(i.relname, ', ' ORDER BY i.relname) AS indexes
+    FROM pg_catalog.pg_index x
+    JOIN pg_catalog.pg_class i ON i.oid = x.indexrelid
+    WHERE x.indrelid = c.oid AND a.attnum = ANY (x.indkey)
+) idx ON true
+WHERE n.nspname = %(schema)s AND c.relkind IN ('r', 'p') AND NOT c.relispartition
+ORDER BY c.relname, a.attnum
+"""
 
 class DatabaseConnector:
-    def __init__(self, source_creds_file='db_creds.yaml', new_db_creds_file='new_db_creds.yaml'):
+    def __init__(self, source_creds_file='db_creds.yaml', new_db_creds_file='new_db_creds.yaml', profile_dir='data_profiles'):
         self.source_creds_file = source_creds_file
         self.new_db_creds_file = new_db_creds_file
+        self.profile_dir = profile_dir
+        self._catalog_snapshots = {}
 
     def read_db_creds(self, creds_file):
         try:
@@ -30,14 +73,53 @@ class DatabaseConnector:
             return None
 
     def list_db_tables(self, creds_file):
-        engine = self.init_db_engine(creds_file)
-        if engine:
-            inspector = inspect(engine)
-            tables = inspector.get_table_names(schema='public')
-            return tables
+        # Served from the cached catalog snapshot rather than a new engine and inspector
+        snapshot = self.get_catalog_snapshot(creds_file)
+        if snapshot is not None:
+            return list(snapshot['table_name'].unique())
         else:
             return []
 
+    def get_catalog_snapshot(self, creds_file, schema='public', refresh=False):
+        # Fetched with a single query and cached until the next load changes the schema
+        key = (creds_file, schema)
+        if refresh or key not in self._catalog_snapshots:
+            connection = self.connect(creds_file)
+            if not connection:
+                return None
+            try:
+                self._catalog_snapshots[key] = pd.read_sql_query(CATALOG_QUERY, connection, params={'schema': schema})
+            except Exception as e:
+                print(f"An error occurred while reading the catalog of schema {schema}: {e}")
+                return None
+            finally:
+                connection.close()
+        return self._catalog_snapshots[key]
+
+    def get_table_schema(self, table_name, creds_file, schema='public'):
+        snapshot = self.get_catalog_snapshot(creds_file, schema)
+        if snapshot is None:
+            return None
+        return snapshot[snapshot['table_name'] == table_name].reset_index(drop=True)
+
+    @staticmethod
+    def diff_catalog(previous, current):
+        # Lists the columns added, removed or changed between two catalog snapshots
+        keys = ['table_name', 'column_name']
+        fields = ['data_type', 'is_nullable', 'constraints', 'indexes']
+        merged = previous[keys + fields].merge(current[keys + fields], on=keys, how='outer', suffixes=('_previous', '_current'), indicator=True)
+        changes = [
+            merged.loc[merged['_merge'] == 'left_only', keys].assign(change='removed'),
+            merged.loc[merged['_merge'] == 'right_only', keys].assign(change='added'),
+        ]
+        both = merged[merged['_merge'] == 'both']
+        for field in fields:
+            before = both[f"{field}_previous"].astype(str).where(both[f"{field}_previous"].notna(), '')
+            after = both[f"{field}_current"].astype(str).where(both[f"{field}_current"].notna(), '')
+            changed = both[before != after]
+            changes.append(changed[keys].assign(change=f"{field} changed", previous=before[before != after], current=after[before != after]))
+        return pd.concat(changes, ignore_index=True).sort_values(keys, ignore_index=True)
+
     def connect(self, creds_file):
         # Using init_db_engine to avoid repeating logic 
         engine = self.init_db_engine(creds_file)
@@ -76,33 +158,139 @@ class DatabaseConnector:
         else:
             return None
 
-    def upload_to_db(self, df, table_name, creds_file):
-        engine = self.init_db_engine(creds_file)
+    def upload_to_db(self, df, table_name, creds_file, if_exists='replace', engine=None, size_varchars=True, partition_column=None, partition_by='list'):
+        # An engine can be passed in to reuse it across chunked uploads.
+        # Returns whether the upload succeeded, so callers loading in several steps can stop on a failure.
+        engine = engine if engine is not None else self.init_db_engine(creds_file)
         if engine:
-            # Calculate max lengths for VARCHAR fields
-            max_card_number_length = df['card_number'].str.len().max() if 'card_number' in df else 0
-            max_store_code_length = df['store_code'].str.len().max() if 'store_code' in df else 0
-            max_product_code_length = df['product_code'].str.len().max() if 'product_code' in df else 0
-            max_country_code_length = df['country_code'].str.len().max() if 'country_code' in df else 0
-
-            dtype = {
-                'date_uuid': types.String,  # Use String for UUID
-                'user_uuid': types.String,  # Use String for UUID
-                'card_number': types.String(max_card_number_length),
-                'store_code': types.String(max_store_code_length),
-                'product_code': types.String(max_product_code_length),
-                'product_quantity': types.SmallInteger,
-                'first_name': types.VARCHAR(255),
-                'last_name': types.VARCHAR(255),
-                'date_of_birth': types.DATE,
-                'country_code': types.String(max_country_code_length),
-                'join_date': types.DATE,
-            }
             try:
-                df.to_sql(table_name, engine, schema='public', if_exists='replace', index=False, dtype=dtype)
+                stats = None
+                if size_varchars:
+                    # One pass over the data sizes the VARCHARs and profiles the load
+                    stats = ColumnStatsCollector().update(df)
+                    # Appends and partition reloads leave the other rows in place, so df is not the whole table
+                    scope = 'full' if if_exists == 'replace' and not partition_column else 'partial'
+                    stats.save(self.profile_path(table_name), table_name, scope)
+                dtype = self.build_dtype(stats)
+                if partition_column:
+                    self.upload_partitioned(df, table_name, engine, dtype, if_exists, partition_column, partition_by)
+                else:
+                    df.to_sql(table_name, engine, schema='public', if_exists=if_exists, index=False, dtype=dtype)
                 print(f"DataFrame successfully uploaded to table {table_name}.")
+                self._catalog_snapshots.clear()
+                return True
             except Exception as e:
                 print(f"An error occurred while uploading the DataFrame to the database: {e}")
+        return False
+
+    def upload_partitioned(self, df, table_name, engine, dtype, if_exists, partition_column, partition_by='list'):
+        # Loads df into a declaratively partitioned table, one partition per value of
+        # partition_column ('list') or per month ('range'). Only the partitions present
+        # in df are touched; with if_exists='replace' they are truncated and reloaded.
+        with engine.begin() as connection:
+            partition_key = f"{partition_by.upper()} ({partition_column})"
+            relkind, existing_key = connection.execute(
+                text("SELECT relkind, pg_get_partkeydef(oid) FROM pg_class WHERE oid = to_regclass(:name)"),
+                {'name': f"public.{table_name}"},
+            ).first() or (None, None)
+            if relkind is not None and (relkind != 'p' or existing_key != partition_key) and if_exists == 'replace':
+                # A plain table or one partitioned on another key or strategy, e.g. by country when loading by month
+                connection.execute(text(f"DROP TABLE public.{table_name}"))
+                relkind = None
+            if relkind is None:
+                create_table = pd.io.sql.get_schema(df, table_name, con=connection, dtype=dtype).strip()
+                connection.execute(text(f"{create_table} PARTITION BY {partition_key}"))
+                connection.execute(text(f"CREATE TABLE public.{table_name}_default PARTITION OF public.{table_name} DEFAULT"))
+
+            for value, rows in df.groupby(partition_column, dropna=False, sort=False):
+                partition = self.create_partition(connection, table_name, value, partition_by)
+                if if_exists == 'replace':
+                    connection.execute(text(f"TRUNCATE TABLE public.{partition}"))
+                rows.to_sql(partition, connection, schema='public', if_exists='append', index=False, dtype=dtype)
+
+    @staticmethod
+    def create_partition(connection, table_name, value, partition_by='list'):
+        # Rows without a partition value go to the default partition
+        if pd.isna(value):
+            return f"{table_name}_default"
+        if partition_by == 'range':
+            start = pd.Timestamp(value).to_period('M').start_time
+            end = start + pd.DateOffset(months=1)
+            partition = f"{table_name}_{start:%Y_%m}"
+            bounds = f"FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+        else:
+            value = str(value)
+            partition = f"{table_name}_{re.sub(r'[^0-9a-z]+', '_', value.lower())}"
+            bounds = "IN ('{}')".format(value.replace("'", "''"))
+        existing_bounds = connection.execute(
+            text("SELECT pg_get_expr(relpartbound, oid) FROM pg_class WHERE oid = to_regclass(:name)"),
+            {'name': f"public.{partition}"},
+        ).scalar()
+        if existing_bounds is None:
+            connection.execute(text(f"CREATE TABLE public.{partition} PARTITION OF public.{table_name} FOR VALUES {bounds}"))
+        elif partition_by != 'range' and existing_bounds != f"FOR VALUES {bounds}":
+            # Values such as 'GB' and 'gb' share a partition name; loading one into the other's partition would fail
+            raise ValueError(f"Partition {partition} already holds {existing_bounds}, not the value {value!r}")
+        return partition
+
+    @staticmethod
+    def build_dtype(stats=None):
+        # VARCHAR lengths come from the column statistics of the load. Chunked loads
+        # only see part of the data, so without stats the VARCHARs are left unbounded.
+        def varchar(column):
+            if stats is None or stats.max_length(column) is None:
+                return types.String
+            # VARCHAR(0) is invalid, e.g. for a column that only held empty strings
+            return types.String(max(stats.max_length(column), 1))
+
+        return {
+            'date_uuid': types.String,  # Use String for UUID
+            'user_uuid': types.String,  # Use String for UUID
+            'card_number': varchar('card_number'),
+            'store_code': varchar('store_code'),
+            'product_code': varchar('product_code'),
+            'product_quantity': types.SmallInteger,
+            'first_name': types.VARCHAR(255),
+            'last_name': types.VARCHAR(255),
+            'date_of_birth': types.DATE,
+            'country_code': varchar('country_code'),
+            'join_date': types.DATE,
+            'order_month': types.DATE,
+            'date_value': types.TIMESTAMP,
+            'month_start': types.DATE,
+        }
+
+    def profile_path(self, table_name):
+        return os.path.join(self.profile_dir, f"{table_name}.json")
+
+    def resize_varchars(self, table_name, stats, creds_file, engine=None, partition_column=None):
+        # Narrows the VARCHARs of a table loaded in chunks once the statistics of every chunk are known.
+        # The type of a partition key cannot be altered, and each column is altered in its own
+        # transaction so that one failure does not roll back the others.
+        engine = engine if engine is not None else self.init_db_engine(creds_file)
+        if engine:
+            for column in VARCHAR_COLUMNS:
+                if column == partition_column or column not in stats.columns or stats.max_length(column) is None:
+                    continue
+                length = max(stats.max_length(column), 1)
+                try:
+                    with engine.begin() as connection:
+                        connection.execute(text(f"ALTER TABLE public.{table_name} ALTER COLUMN {column} TYPE VARCHAR({length})"))
+                    print(f"Column {column} of table {table_name} resized to VARCHAR({length}).")
+                except Exception as e:
+                    print(f"An error occurred while resizing column {column} of {table_name}: {e}")
+            self._catalog_snapshots.clear()
+
+    def create_index(self, table_name, column_name, creds_file):
+        engine = self.init_db_engine(creds_file)
+        if engine:
+            try:
+                with engine.begin() as connection:
+                    connection.execute(text(f"CREATE INDEX IF NOT EXISTS {table_name}_{column_name}_idx ON public.{table_name} ({column_name})"))
+                print(f"Index on {table_name}.{column_name} created.")
+                self._catalog_snapshots.clear()
+            except Exception as e:
+                print(f"An error occurred while creating the index on {table_name}.{column_name}: {e}")
 
     def get_current_database(self, creds_file):
         connection = self.connect(creds_file)
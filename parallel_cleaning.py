@@ -0,0 +1,223 @@
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from data_cleaning import DataCleaning
+
+
+# Joins the values of a text column; it cannot occur inside a value that is packed
+_SEPARATOR = '\x00'
+
+
+def _pack_text_columns(partition):
+    """
+    Moves the text columns of a partition into NumPy buffers.
+
+    Pickle keeps Python strings in-band, so every text column is joined into
+    one UTF-8 buffer that can go through shared memory like the numeric
+    columns. The null values are kept aside, and columns holding non-string
+    values or the separator itself are left in the frame as they are.
+
+    Returns
+    -------
+    tuple
+        The partition without the packed columns and, per packed column, its
+        UTF-8 buffer, null mask, null values and dtype.
+    """
+    packed = {}
+    for column in partition.columns:
+        values = partition[column]
+        if not len(values) or not (pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)):
+            continue
+        nulls = values.isna().to_numpy()
+        try:
+            text = _SEPARATOR.join(values.to_numpy(dtype=object, na_value=''))
+        except TypeError:
+            continue  # non-string values
+        if text.count(_SEPARATOR) != len(values) - 1:
+            continue
+        null_values = values.to_numpy(dtype=object)[nulls]
+        packed[column] = (np.frombuffer(text.encode('utf-8'), dtype=np.uint8), nulls, null_values, values.dtype)
+    return partition.drop(columns=list(packed)), packed
+
+
+def _unpack_text_columns(partition, packed, columns):
+    """Rebuilds the text columns packed by _pack_text_columns in their original order."""
+    for column, (data, nulls, null_values, dtype) in packed.items():
+        values = np.array(bytes(data).decode('utf-8').split(_SEPARATOR), dtype=object)
+        values[nulls] = null_values
+        partition[column] = pd.Series(values, index=partition.index, dtype=dtype)
+    return partition[columns]
+
+
+def _partition_to_shared_memory(partition):
+    """
+    Serialises a DataFrame partition into a shared memory block.
+
+    The text columns are packed into UTF-8 buffers first, then the partition
+    is pickled with protocol 5 so that the column arrays are emitted as
+    out-of-band buffers. Those buffers are copied once into the shared
+    memory block and only the pickle header, which still holds the columns
+    that could not be packed, travels through the pool's pipe.
+
+    Returns
+    -------
+    tuple
+        The SharedMemory block, the pickle header and the buffer sizes.
+    """
+    raw_buffers = []
+
+    def collect(buffer):
+        try:
+            raw_buffers.append(buffer.raw())
+        except BufferError:
+            return True  # non-contiguous buffers stay in-band
+        return False
+
+    frame, packed = _pack_text_columns(partition)
+    header = pickle.dumps((frame, packed, list(partition.columns)), protocol=5, buffer_callback=collect)
+    sizes = [raw.nbytes for raw in raw_buffers]
+    shm = shared_memory.SharedMemory(create=True, size=max(sum(sizes), 1))
+    offset = 0
+    for raw, size in zip(raw_buffers, sizes):
+        shm.buf[offset:offset + size] = raw
+        offset += size
+    return shm, header, sizes
+
+
+def _clean_partition(cleaner_class, method_name, shm_name, header, sizes):
+    """Runs one cleaning method on a partition read from shared memory."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    views = []
+    try:
+        offset = 0
+        for size in sizes:
+            views.append(shm.buf[offset:offset + size])
+            offset += size
+        frame, packed, columns = pickle.loads(header, buffers=views)
+        partition = _unpack_text_columns(frame, packed, columns)
+        del frame, packed
+        result = getattr(cleaner_class(), method_name)(partition)
+        # Detach the result from the shared block before it is released
+        result = result.copy(deep=True)
+        del partition
+        return result
+    finally:
+        for view in views:
+            view.release()
+        shm.close()
+
+
+class ParallelCleaner:
+    """
+    Runs DataCleaning methods across a process pool on row partitions.
+
+    The frame is split into contiguous row partitions which are handed to the
+    workers through shared memory, and the cleaned partitions are concatenated
+    back in their original order. The clean_* methods work row by row, so
+    the output is identical to calling the method serially on the whole frame.
+    Partitions left empty by the cleaning are not concatenated, as their
+    columns can have a different dtype than the serial result.
+    Methods that also drop duplicates across rows register the step in
+    merge_steps, which is repeated on the stitched result.
+
+    The pool is started on the first parallel run and kept until close(), so
+    a streamed load can clean every chunk with the same workers. Splitting
+    and packing the partitions happens in the calling process, so the pool
+    only pays off for methods that do a lot of per-row Python work, such as
+    clean_orders_data.
+
+    Attributes
+    ----------
+    cleaner : DataCleaning
+        The cleaner whose methods are executed. Its class is instantiated in
+        every worker, so subclasses of DataCleaning are supported.
+    workers : int
+        The number of worker processes.
+    min_rows : int
+        Frames with fewer rows than this are cleaned serially.
+
+    Methods
+    -------
+    run(method_name, df):
+        Runs the named cleaning method on df using the process pool.
+    close():
+        Shuts the process pool down.
+    """
+
+    # Cross-row steps that must be applied again after the partitions are concatenated
+    merge_steps = {
+        'clean_card_data': lambda df: df.drop_duplicates(subset=['card_number']),
+    }
+
+    def __init__(self, cleaner=None, workers=None, min_rows=50000):
+        self.cleaner = cleaner if cleaner is not None else DataCleaning()
+        self.workers = workers or os.cpu_count() or 1
+        self.min_rows = min_rows
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_executor(self):
+        if self._executor is None:
+            # The pool can be started from a pipeline thread, and forking a process that runs threads is unsafe
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def run(self, method_name, df):
+        """
+        Runs the named cleaning method on df using the process pool.
+
+        Parameters
+        ----------
+        method_name : str
+            The name of the DataCleaning method, e.g. 'clean_orders_data'.
+        df : DataFrame
+            The DataFrame to clean.
+
+        Returns
+        -------
+        DataFrame
+            The cleaned DataFrame, identical to the serial result.
+        """
+        method = getattr(self.cleaner, method_name)
+        if self.workers <= 1 or len(df) < self.min_rows:
+            return method(df)
+
+        bounds = np.linspace(0, len(df), self.workers + 1).astype(int)
+        blocks = []
+        try:
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                if stop > start:
+                    blocks.append(_partition_to_shared_memory(df.iloc[start:stop].copy()))
+            executor = self._get_executor()
+            futures = [
+                executor.submit(_clean_partition, type(self.cleaner), method_name, shm.name, header, sizes)
+                for shm, header, sizes in blocks
+            ]
+            results = [future.result() for future in futures]
+        finally:
+            for shm, _, _ in blocks:
+                shm.close()
+                shm.unlink()
+
+        # An empty partition could turn e.g. a str column into object
+        df = pd.concat([result for result in results if len(result)] or results[:1])
+        if method_name in self.merge_steps:
+            df = self.merge_steps[method_name](df)
+        return df
@@ -0,0 +1,243 @@
+import atexit
+import contextlib
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# Setting this environment variable to a directory turns profiling on
+PROFILE_ENV_VAR = 'MRDC_PROFILE_DIR'
+
+_NO_PROFILING = contextlib.nullcontext()
+_profiler = None
+
+
+class StageProfile:
+    """
+    Accumulated cProfile, allocation and stack samples for one pipeline stage.
+
+    A stage can be entered many times, e.g. once per chunk in a streaming
+    load; every entry adds to the same profile.
+
+    Attributes
+    ----------
+    name : str
+        The name of the stage, used for the report file names.
+    profile : cProfile.Profile
+        The deterministic profile of the stage.
+    allocations : Counter
+        Bytes allocated during the stage, keyed by allocation site.
+    allocation_counts : Counter
+        Number of blocks allocated during the stage, keyed by allocation site.
+    stacks : Counter
+        Sampled call stacks of the stage in collapsed form.
+    peak : int or None
+        The highest traced memory seen while the stage ran alone. tracemalloc
+        keeps a single process-wide peak, so entries that overlap another
+        stage cannot be attributed and only count towards Profiler.peak.
+    overlapped_calls : int
+        The number of entries that overlapped another stage.
+    calls : int
+        The number of times the stage was entered.
+    profiled_calls : int
+        The number of entries that ran under cProfile. From Python 3.12 only
+        one cProfile can be active per process, so an entry that overlaps
+        another profiled stage is only sampled and allocation-tracked.
+    seconds : float
+        The total wall time spent in the stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.allocations = Counter()
+        self.allocation_counts = Counter()
+        self.stacks = Counter()
+        self.peak = None
+        self.calls = 0
+        self.overlapped_calls = 0
+        self.profiled_calls = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record_allocations(self, before, after):
+        with self._lock:
+            for stat in after.compare_to(before, 'lineno'):
+                if stat.size_diff > 0:
+                    frame = stat.traceback[0]
+                    site = f"{frame.filename}:{frame.lineno}"
+                    self.allocations[site] += stat.size_diff
+                    self.allocation_counts[site] += stat.count_diff
+
+    def record_stack(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        with self._lock:
+            self.stacks[';'.join(reversed(stack))] += 1
+
+
+class Profiler:
+    """
+    Wraps pipeline stages with cProfile, tracemalloc and a stack sampler.
+
+    For every stage it writes to output_dir:
+      - <stage>.pstats: the cProfile statistics, readable with pstats or snakeviz.
+      - <stage>.alloc.txt: the top allocation sites and the peak traced memory.
+      - <stage>.collapsed: sampled stacks in collapsed format for flamegraph.pl
+        or speedscope.
+
+    Attributes
+    ----------
+    output_dir : str
+        The directory the reports are written to.
+    sample_interval : float
+        Seconds between two stack samples.
+    top : int
+        The number of allocation sites listed in each report.
+    peak : int
+        The highest traced memory seen at the end of any stage, process wide.
+
+    Methods
+    -------
+    stage(name):
+        Context manager profiling the enclosed block as the named stage.
+    write_reports():
+        Writes the report files of every stage profiled so far.
+    """
+
+    def __init__(self, output_dir, sample_interval=0.005, top=25):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.top = top
+        self.stages = {}
+        self.peak = 0
+        self._lock = threading.Lock()
+        self._running = []  # one overlap flag per stage entry in progress
+        os.makedirs(output_dir, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _get_stage(self, name):
+        with self._lock:
+            if name not in self.stages:
+                self.stages[name] = StageProfile(name)
+            return self.stages[name]
+
+    def _sample(self, stage, thread_id, stop):
+        while not stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stage.record_stack(frame)
+
+    @staticmethod
+    def _enable(profile):
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows a single active cProfile per process, which another stage holds
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stage = self._get_stage(name)
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample, args=(stage, threading.get_ident(), stop), daemon=True)
+        before = tracemalloc.take_snapshot()
+        overlapped = [False]
+        with self._lock:
+            if self._running:
+                # reset_peak is process wide, so it would clobber the peak of the stages already running
+                overlapped[0] = True
+                for other in self._running:
+                    other[0] = True
+            else:
+                tracemalloc.reset_peak()
+            self._running.append(overlapped)
+        start = time.perf_counter()
+        sampler.start()
+        profiled = self._enable(stage.profile)
+        try:
+            yield stage
+        finally:
+            if profiled:
+                stage.profile.disable()
+            stop.set()
+            sampler.join()
+            stage.seconds += time.perf_counter() - start
+            stage.calls += 1
+            stage.profiled_calls += profiled
+            with self._lock:
+                self._running.remove(overlapped)
+                peak = tracemalloc.get_traced_memory()[1]
+                self.peak = max(self.peak, peak)
+            if overlapped[0]:
+                stage.overlapped_calls += 1
+            else:
+                stage.peak = max(stage.peak or 0, peak)
+            stage.record_allocations(before, tracemalloc.take_snapshot())
+
+    def write_reports(self):
+        for stage in self.stages.values():
+            path = os.path.join(self.output_dir, stage.name)
+            if stage.profiled_calls:
+                # pstats cannot load a profile that never ran
+                pstats.Stats(stage.profile).dump_stats(f"{path}.pstats")
+            with open(f"{path}.alloc.txt", 'w') as file:
+                file.write(f"Stage {stage.name}: {stage.calls} calls ({stage.profiled_calls} under cProfile), {stage.seconds:.3f}s\n")
+                if stage.peak is not None:
+                    file.write(f"Peak traced memory while running alone: {stage.peak / 1024 / 1024:.1f} MiB\n")
+                if stage.overlapped_calls:
+                    file.write(f"{stage.overlapped_calls} calls overlapped other stages and have no peak of their own\n")
+                file.write(f"Process-wide peak traced memory: {self.peak / 1024 / 1024:.1f} MiB\n")
+                file.write(f"Top {self.top} allocation sites:\n")
+                for site, size in stage.allocations.most_common(self.top):
+                    file.write(f"{size / 1024:12.1f} KiB  {stage.allocation_counts[site]:10d} blocks  {site}\n")
+            with open(f"{path}.collapsed", 'w') as file:
+                for stack, count in stage.stacks.items():
+                    file.write(f"{stack} {count}\n")
+        print(f"Profiling reports written to {self.output_dir}.")
+
+
+def enable_profiling(output_dir):
+    """
+    Turns profiling on for the rest of the run.
+
+    Parameters
+    ----------
+    output_dir : str
+        The directory the reports are written to when the process exits.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(output_dir)
+        atexit.register(_profiler.write_reports)
+    return _profiler
+
+
+def profile_stage(name):
+    """
+    Returns a context manager that profiles the enclosed block as a stage.
+
+    When profiling is disabled this returns a shared no-op context manager,
+    so wrapping a stage costs nothing.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage, e.g. 'orders_table.clean'.
+    """
+    if _profiler is None:
+        return _NO_PROFILING
+    return _profiler.stage(name)
+
+
+if os.environ.get(PROFILE_ENV_VAR):
+    enable_profiling(os.environ[PROFILE_ENV_VAR])
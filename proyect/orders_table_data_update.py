@@ -1,11 +1,27 @@
+import json
+import os
 import psycopg2
 import yaml
 
-def get_max_length(cursor, table_name, column_name):
-    cursor.execute(f"SELECT MAX(LENGTH({column_name})) FROM {table_name};")
-    max_length = cursor.fetchone()[0]
-    print(f"Max length for {column_name} in {table_name} is {max_length}")
-    return max_length
+def get_max_lengths(cursor, table_name, column_names, profile_file=None):
+    # Prefer the data profile written by the last load, otherwise scan the table once for all columns.
+    # Only a profile of a full-table load describes every row; older profiles have no scope and are not trusted.
+    max_lengths = None
+    if profile_file and os.path.exists(profile_file):
+        with open(profile_file, 'r') as file:
+            profile = json.load(file)
+        columns = profile['columns'] if profile.get('scope') == 'full' else {}
+        if all(columns.get(column_name, {}).get('max_length') is not None for column_name in column_names):
+            max_lengths = {column_name: columns[column_name]['max_length'] for column_name in column_names}
+    if max_lengths is None:
+        select = ", ".join(f"MAX(LENGTH({column_name}))" for column_name in column_names)
+        cursor.execute(f"SELECT {select} FROM {table_name};")
+        max_lengths = dict(zip(column_names, cursor.fetchone()))
+    # VARCHAR(0) is invalid, and MAX is NULL for an empty table
+    max_lengths = {column_name: max(max_length or 0, 1) for column_name, max_length in max_lengths.items()}
+    for column_name, max_length in max_lengths.items():
+        print(f"Max length for {column_name} in {table_name} is {max_length}")
+    return max_lengths
 
 def execute_sql_commands(commands, creds_file):
     with open(creds_file, 'r') as file:
@@ -50,9 +66,10 @@ if __name__ == "__main__":
     
     try:
         print("Calculating max lengths...")
-        max_card_number_length = get_max_length(cursor, 'orders_table', 'card_number')
-        max_store_code_length = get_max_length(cursor, 'orders_table', 'store_code')
-        max_product_code_length = get_max_length(cursor, 'orders_table', 'product_code')
+        max_lengths = get_max_lengths(cursor, 'orders_table', ['card_number', 'store_code', 'product_code'], 'data_profiles/orders_table.json')
+        max_card_number_length = max_lengths['card_number']
+        max_store_code_length = max_lengths['store_code']
+        max_product_code_length = max_lengths['product_code']
         
         sql_commands = [
             f"ALTER TABLE orders_table ALTER COLUMN date_uuid TYPE UUID USING date_uuid::UUID;",
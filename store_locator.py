@@ -0,0 +1,247 @@
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Vectorized great-circle distance in kilometres.
+
+    The arguments are degrees and broadcast against each other like any
+    NumPy expression.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=float)) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _to_unit_vectors(latitudes, longitudes):
+    lat = np.radians(np.asarray(latitudes, dtype=float))
+    lon = np.radians(np.asarray(longitudes, dtype=float))
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+def _chord(distance_km):
+    # Straight-line distance between two points on the unit sphere, which grows with the great-circle distance
+    return 2 * np.sin(np.minimum(np.asarray(distance_km, dtype=float) / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+class StoreLocationIndex:
+    """
+    A uniform grid over the stores' positions for nearest-store and radius queries.
+
+    The coordinates are projected to 3D unit vectors, so the grid has no
+    seams at the antimeridian or the poles, and bucketed into cubic cells of
+    cell_km. A query only computes haversine distances for the stores in the
+    cells around it.
+
+    Attributes
+    ----------
+    stores : DataFrame
+        store_code, latitude, longitude and the grid cell of every store.
+    cell_km : float
+        The edge length of a grid cell, roughly in kilometres.
+
+    Methods
+    -------
+    from_frame(stores_df, cell_km):
+        Builds the index from the cleaned store data or the persisted dim_store_locations table.
+    to_frame():
+        Returns the stores with their grid cells, ready to upload as dim_store_locations.
+    nearest(latitudes, longitudes, k):
+        Finds the k nearest stores to every query point.
+    within_radius(latitudes, longitudes, radius_km):
+        Finds all stores within radius_km of every query point.
+    """
+
+    # Up to this many store/query pairs, comparing every query with every store beats the grid
+    brute_force_pairs = 20_000_000
+    # The number of pairs compared at once, which bounds the memory of a batch
+    block_pairs = 1 << 20
+    # The number of queries answered together when the grid is used
+    queries_per_batch = 32
+
+    def __init__(self, store_codes, latitudes, longitudes, cell_km=50.0):
+        self.cell_km = cell_km
+        self._cell = float(_chord(cell_km))
+        points = _to_unit_vectors(latitudes, longitudes)
+        cells = np.floor(points / self._cell).astype(np.int64)
+        keys = self._cell_keys(cells)
+
+        # Sort the stores by cell so every cell is a contiguous run
+        order = np.argsort(keys, kind='stable')
+        self._points = points[order]
+        self._keys, self._starts, self._counts = np.unique(keys[order], return_index=True, return_counts=True)
+        self.stores = pd.DataFrame({
+            'store_code': np.asarray(store_codes)[order],
+            'latitude': np.asarray(latitudes, dtype=float)[order],
+            'longitude': np.asarray(longitudes, dtype=float)[order],
+            'cell_x': cells[order, 0],
+            'cell_y': cells[order, 1],
+            'cell_z': cells[order, 2],
+        })
+        self._store_codes = self.stores['store_code'].to_numpy()
+        self._latitudes = self.stores['latitude'].to_numpy()
+        self._longitudes = self.stores['longitude'].to_numpy()
+
+    @classmethod
+    def from_frame(cls, stores_df, cell_km=50.0):
+        # Stores without a location, such as the web store, cannot be indexed
+        stores_df = stores_df.dropna(subset=['latitude', 'longitude'])
+        return cls(stores_df['store_code'].to_numpy(), stores_df['latitude'].to_numpy(), stores_df['longitude'].to_numpy(), cell_km)
+
+    def to_frame(self):
+        return self.stores.copy()
+
+    @staticmethod
+    def _cell_keys(cells):
+        # Pack the three cell coordinates into one integer; a cell is never smaller than ~1e-6 of the sphere
+        cells = cells + (1 << 20)
+        return (cells[..., 0] << 42) | (cells[..., 1] << 21) | cells[..., 2]
+
+    def _candidates(self, low, high):
+        # Stores in every cell overlapping the box from low to high
+        low = np.floor(low / self._cell).astype(np.int64)
+        high = np.floor(high / self._cell).astype(np.int64)
+        if np.prod(high - low + 1) > len(self._keys):
+            # The box covers more cells than are occupied, so scanning every store is cheaper
+            return np.arange(len(self._points))
+        grid = np.stack(np.meshgrid(*(np.arange(lo, hi + 1) for lo, hi in zip(low, high)), indexing='ij'), axis=-1)
+        keys = self._cell_keys(grid.reshape(-1, 3))
+        positions = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        positions = positions[self._keys[positions] == keys]
+        starts = self._starts[positions]
+        counts = self._counts[positions]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(starts, counts) + offsets
+
+    def _query_batches(self, points):
+        # Yields the query indexes to answer together and the box around them, as two corners.
+        # Few stores times few queries are cheaper to compare all at once, in blocks with no box.
+        if len(self._points) * len(points) <= self.brute_force_pairs:
+            block = max(1, self.block_pairs // max(len(self._points), 1))
+            for start in range(0, len(points), block):
+                yield np.arange(start, min(start + block, len(points))), None
+            return
+        # Sparse queries would mostly get a batch of their own, so the batch boxes are made
+        # coarser than the grid until the batches hold about queries_per_batch queries
+        size = self._cell
+        while True:
+            boxes = np.floor(points / size).astype(np.int64)
+            keys = self._cell_keys(boxes)
+            distinct = np.unique(keys)
+            if len(distinct) * self.queries_per_batch <= len(points) or size >= 2:
+                break
+            size *= 2
+        order = np.argsort(keys, kind='stable')
+        _, starts = np.unique(keys[order], return_index=True)
+        for queries in np.split(order, starts[1:]):
+            box = boxes[queries[0]]
+            yield queries, (box * size, (box + 1) * size)
+
+    def _box_candidates(self, box, chord):
+        # Every store within chord of any point of the box; no box stands for every store
+        if box is None:
+            return np.arange(len(self._points))
+        low, high = box
+        return self._candidates(low - chord, high + chord)
+
+    def _haversine(self, latitudes, longitudes, queries, stores):
+        # Distances from each query to its own row of stores
+        return haversine_km(latitudes[queries][:, None], longitudes[queries][:, None], self._latitudes[stores], self._longitudes[stores])
+
+    def within_radius(self, latitudes, longitudes, radius_km):
+        """
+        Finds all stores within radius_km of every query point.
+
+        Parameters
+        ----------
+        latitudes, longitudes : array-like
+            The query points in degrees.
+        radius_km : float
+            The search radius in kilometres.
+
+        Returns
+        -------
+        DataFrame
+            One row per match with query_index, store_code and distance_km,
+            sorted by query and distance.
+        """
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=float))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=float))
+        points = _to_unit_vectors(latitudes, longitudes)
+        chord = float(_chord(radius_km))
+        # The dot product of two unit vectors falls as their distance grows, so one matrix product
+        # screens the pairs; the margin keeps pairs right at the radius for the exact haversine check
+        min_dot = 1 - chord * chord / 2 - 1e-9
+        matches = []
+        for queries, box in self._query_batches(points):
+            candidates = self._box_candidates(box, chord)
+            rows, columns = np.nonzero(points[queries] @ self._points[candidates].T >= min_dot)
+            distances = self._haversine(latitudes, longitudes, queries[rows], candidates[columns, None])[:, 0]
+            hits = distances <= radius_km
+            matches.append((queries[rows][hits], candidates[columns][hits], distances[hits]))
+        return self._matches_frame(matches)
+
+    def nearest(self, latitudes, longitudes, k=1):
+        """
+        Finds the k nearest stores to every query point.
+
+        Nearby queries are answered together. The search starts with the
+        cells around their box and doubles its radius until every query has
+        k stores within the radius, so the result is exact.
+
+        Parameters
+        ----------
+        latitudes, longitudes : array-like
+            The query points in degrees.
+        k : int
+            The number of stores to return per query point.
+
+        Returns
+        -------
+        DataFrame
+            One row per match with query_index, store_code and distance_km,
+            sorted by query and distance.
+        """
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=float))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=float))
+        points = _to_unit_vectors(latitudes, longitudes)
+        k = min(k, len(self.stores))
+        matches = []
+        if k <= 0:
+            return self._matches_frame(matches)
+        for queries, box in self._query_batches(points):
+            chord = self._cell
+            while True:
+                candidates = self._box_candidates(box, chord)
+                # A chord of 2 spans the whole sphere, so every store is a candidate
+                if box is None or chord >= 2:
+                    break
+                dots = points[queries] @ self._points[candidates].T
+                if ((dots >= 1 - chord * chord / 2).sum(axis=1) >= k).all():
+                    break
+                chord *= 2
+            # The nearest stores have the largest dot products, so haversine is only computed for the k picked
+            dots = points[queries] @ self._points[candidates].T
+            best = candidates[np.argpartition(-dots, k - 1, axis=1)[:, :k]]
+            distances = self._haversine(latitudes, longitudes, queries, best)
+            order = np.lexsort((best, distances))
+            matches.append((
+                np.repeat(queries, k),
+                np.take_along_axis(best, order, axis=1).ravel(),
+                np.take_along_axis(distances, order, axis=1).ravel(),
+            ))
+        return self._matches_frame(matches)
+
+    def _matches_frame(self, matches):
+        if not matches:
+            return pd.DataFrame({'query_index': [], 'store_code': [], 'distance_km': []})
+        queries, stores, distances = (np.concatenate(parts) for parts in zip(*matches))
+        frame = pd.DataFrame({
+            'query_index': queries,
+            'store_code': self._store_codes[stores],
+            'distance_km': distances,
+        })
+        return frame.sort_values(['query_index', 'distance_km'], ignore_index=True, kind='stable')
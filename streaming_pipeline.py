@@ -0,0 +1,269 @@
+import queue
+import threading
+import time
+from profiling import profile_stage
+from column_stats import ColumnStatsCollector
+
+_DONE = object()
+_DEFAULT_PARTITION = 'default'
+
+
+class StageStats:
+    """
+    Timing counters for one pipeline stage.
+
+    Attributes
+    ----------
+    name : str
+        The name of the stage.
+    busy : float
+        Seconds spent doing the stage's own work.
+    starved : float
+        Seconds spent waiting for a chunk from the previous stage.
+    blocked : float
+        Seconds spent waiting for room in the queue to the next stage.
+    chunks : int
+        The number of chunks processed.
+    rows : int
+        The number of rows processed.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.chunks = 0
+        self.rows = 0
+
+
+class StreamingPipeline:
+    """
+    Overlaps extraction, cleaning and upload of one source with bounded queues.
+
+    Each stage runs in its own thread and hands chunks to the next stage
+    through a queue of at most max_queue chunks, so chunk N can be uploaded
+    while chunk N+1 is cleaned and chunk N+2 is fetched. A full queue blocks
+    the upstream stage, which keeps the number of chunks held in memory
+    bounded.
+
+    Attributes
+    ----------
+    chunks : iterable
+        The source of DataFrame chunks, e.g. DataExtractor.extract_from_db_in_chunks.
+    clean : callable
+        The cleaning function applied to every chunk, e.g. DataCleaning.clean_orders_data.
+    db_connector : DatabaseConnector
+        The connector used to upload the cleaned chunks.
+    table_name : str
+        The name of the destination table.
+    creds_file : str
+        The path to the credentials file of the destination database.
+    max_queue : int
+        The maximum number of chunks waiting between two stages.
+    column_stats : ColumnStatsCollector
+        Statistics of the cleaned chunks, used to size the VARCHARs after the
+        load and saved as the table's data profile.
+    partition_column : str
+        If given, the table is loaded as a partitioned table on this column
+        (see DatabaseConnector.upload_partitioned) and only the partitions
+        present in the stream are reloaded.
+    partition_by : str
+        'list' for one partition per value or 'range' for one partition per month.
+
+    Methods
+    -------
+    run():
+        Runs the pipeline to completion and returns the per-stage report.
+    """
+
+    def __init__(self, chunks, clean, db_connector, table_name, creds_file, max_queue=2, partition_column=None, partition_by='list'):
+        self.chunks = chunks
+        self.clean = clean
+        self.db_connector = db_connector
+        self.table_name = table_name
+        self.creds_file = creds_file
+        self.max_queue = max_queue
+        self.partition_column = partition_column
+        self.partition_by = partition_by
+        self.stats = {name: StageStats(name) for name in ('extract', 'clean', 'upload')}
+        self.column_stats = ColumnStatsCollector()
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _put(self, q, item, stats):
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        stats.blocked += time.perf_counter() - start
+
+    def _get(self, q, stats):
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        else:
+            item = _DONE
+        stats.starved += time.perf_counter() - start
+        return item
+
+    def _extract(self, out_queue):
+        stats = self.stats['extract']
+        chunks = None
+        try:
+            chunks = iter(self.chunks)
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                with profile_stage(f"{self.table_name}.extract"):
+                    chunk = next(chunks, _DONE)
+                stats.busy += time.perf_counter() - start
+                if chunk is _DONE:
+                    break
+                stats.chunks += 1
+                stats.rows += len(chunk)
+                self._put(out_queue, chunk, stats)
+        except Exception as e:
+            self._fail('extract', e)
+        finally:
+            # Closing the generator early releases e.g. the server-side cursor of extract_from_db_in_chunks
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+            self._put(out_queue, _DONE, stats)
+
+    def _clean(self, in_queue, out_queue):
+        stats = self.stats['clean']
+        try:
+            while True:
+                chunk = self._get(in_queue, stats)
+                if chunk is _DONE:
+                    break
+                start = time.perf_counter()
+                with profile_stage(f"{self.table_name}.clean"):
+                    cleaned = self.clean(chunk)
+                    self.column_stats.update(cleaned)
+                stats.busy += time.perf_counter() - start
+                stats.chunks += 1
+                stats.rows += len(cleaned)
+                self._put(out_queue, cleaned, stats)
+        except Exception as e:
+            self._fail('clean', e)
+        finally:
+            self._put(out_queue, _DONE, stats)
+
+    def _upload(self, in_queue):
+        stats = self.stats['upload']
+        if_exists = 'replace'
+        loaded_partitions = set()
+        try:
+            engine = self.db_connector.init_db_engine(self.creds_file)
+            while True:
+                chunk = self._get(in_queue, stats)
+                if chunk is _DONE:
+                    break
+                start = time.perf_counter()
+                with profile_stage(f"{self.table_name}.upload"):
+                    if self.partition_column:
+                        # A partition is truncated by the first chunk that contains it and appended to afterwards
+                        keys = chunk[self.partition_column]
+                        if self.partition_by == 'range':
+                            keys = keys.dt.to_period('M')
+                        keys = keys.astype(object).where(keys.notna(), _DEFAULT_PARTITION)
+                        first_seen = ~keys.isin(loaded_partitions)
+                        for rows, mode in ((chunk[first_seen], 'replace'), (chunk[~first_seen], 'append')):
+                            if len(rows):
+                                self._upload_chunk(rows, mode, engine)
+                        loaded_partitions.update(keys[first_seen].unique())
+                    else:
+                        self._upload_chunk(chunk, if_exists, engine)
+                stats.busy += time.perf_counter() - start
+                stats.chunks += 1
+                stats.rows += len(chunk)
+                if_exists = 'append'
+        except Exception as e:
+            self._fail('upload', e)
+
+    def _upload_chunk(self, chunk, if_exists, engine):
+        # VARCHAR lengths of a single chunk are not final, so they are left unbounded until resize_varchars
+        uploaded = self.db_connector.upload_to_db(
+            chunk, self.table_name, self.creds_file, if_exists=if_exists, engine=engine, size_varchars=False,
+            partition_column=self.partition_column, partition_by=self.partition_by,
+        )
+        if not uploaded:
+            # upload_to_db has already printed the cause; stop here instead of loading the remaining chunks
+            raise RuntimeError(f"chunk of {len(chunk)} rows could not be uploaded")
+
+    def _fail(self, stage, error):
+        print(f"An error occurred in the {stage} stage of the {self.table_name} pipeline: {error}")
+        self._errors.append(error)
+        self._stop.set()
+
+    def run(self):
+        """
+        Runs the pipeline to completion and returns the per-stage report.
+
+        Returns
+        -------
+        dict
+            For every stage, its utilization (busy time over wall time), the
+            seconds spent busy, starved and blocked, and the chunks and rows
+            processed, plus the total wall time, the limiting stage and whether
+            any stage failed. A failed run is not resized and its profile is marked
+            partial.
+        """
+        raw_queue = queue.Queue(maxsize=self.max_queue)
+        clean_queue = queue.Queue(maxsize=self.max_queue)
+        threads = [
+            threading.Thread(target=self._extract, args=(raw_queue,), name=f"{self.table_name}-extract"),
+            threading.Thread(target=self._clean, args=(raw_queue, clean_queue), name=f"{self.table_name}-clean"),
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            self._upload(clean_queue)
+        except BaseException:
+            # e.g. KeyboardInterrupt; the other stages must stop or the threads can never be joined
+            self._stop.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+        # The statistics gathered while cleaning cover the whole table only after a successful,
+        # unpartitioned run; otherwise the profile is still rewritten so an older full one is not trusted
+        scope = 'partial' if self._errors or self.partition_column else 'full'
+        self.column_stats.save(self.db_connector.profile_path(self.table_name), self.table_name, scope)
+        if not self._errors:
+            self.db_connector.resize_varchars(self.table_name, self.column_stats, self.creds_file, partition_column=self.partition_column)
+        wall = time.perf_counter() - start
+
+        report = {'wall': wall, 'stages': {}}
+        for stats in self.stats.values():
+            report['stages'][stats.name] = {
+                'utilization': stats.busy / wall if wall else 0.0,
+                'busy': stats.busy,
+                'starved': stats.starved,
+                'blocked': stats.blocked,
+                'chunks': stats.chunks,
+                'rows': stats.rows,
+            }
+        report['limiting_stage'] = max(self.stats.values(), key=lambda stats: stats.busy).name
+        report['failed'] = bool(self._errors)
+        self.print_report(report)
+        return report
+
+    def print_report(self, report):
+        print(f"Pipeline for {self.table_name} finished in {report['wall']:.2f}s, limited by the {report['limiting_stage']} stage.")
+        for name, stage in report['stages'].items():
+            print(
+                f"  {name:<8} utilization {stage['utilization']:6.1%}  busy {stage['busy']:.2f}s  "
+                f"starved {stage['starved']:.2f}s  blocked {stage['blocked']:.2f}s  "
+                f"{stage['chunks']} chunks, {stage['rows']} rows"
+            )